@@ -12,15 +12,20 @@ import asyncio
 import socket
 import datetime
 import os
-import json
 import re
-import threading
+import time
+import xml.parsers.expat
+import xml.etree.ElementTree as ET
+from itertools import chain
+from operator import itemgetter
 from pathlib import Path
-from typing import Optional, List
+from typing import Optional, Set
 from contextlib import asynccontextmanager
+from functools import partial
 
+import orjson
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 
 # Configuration
@@ -35,6 +40,15 @@ CAPTURES_DIR.mkdir(exist_ok=True)
 # Set ACCEPT_OBSERVATIONS=true to accept (AA) and mark data as sent on device
 ACCEPT_OBSERVATIONS = os.environ.get("ACCEPT_OBSERVATIONS", "").lower() == "true"
 
+# Device socket tuning: fewer, larger reads while a transfer streams in.
+# The bigger receive buffer costs ~256 KB per open connection. Transfers
+# run one at a time, but a connection waiting for its turn holds one too.
+DEVICE_RECV_SIZE = 65536
+DEVICE_RCVBUF = 256 * 1024
+
+# Minimum time between progress updates sent to the UI during a transfer
+PROGRESS_INTERVAL_NS = 100_000_000
+
 # Version
 def get_version():
     version_file = Path(__file__).parent / "VERSION"
@@ -50,9 +64,11 @@ class AppState:
         self.device_connected = False
         self.transfer_in_progress = False
         self.observations_received = 0
+        self.last_progress_ns = 0
         self.device_info = {}
-        self.websocket_clients: List[WebSocket] = []
-        self.server_running = False
+        self.websocket_clients: Set[WebSocket] = set()
+        self.device_lock: Optional[asyncio.Lock] = None
+        self.device_tasks: Set[asyncio.Task] = set()
         self.local_ip = self._get_local_ip()
 
     def _get_local_ip(self):
@@ -67,55 +83,44 @@ class AppState:
 
 state = AppState()
 
-# WebSocket broadcast
+# WebSocket messages are sent as orjson-encoded binary frames
+async def ws_send(client: WebSocket, message: dict):
+    """Send message to a single WebSocket client."""
+    await client.send_bytes(orjson.dumps(message))
+
 async def broadcast(message: dict):
     """Send message to all connected WebSocket clients."""
-    for client in state.websocket_clients[:]:
-        try:
-            await client.send_json(message)
-        except:
-            state.websocket_clients.remove(client)
-
-def sync_broadcast(message: dict):
-    """Synchronous wrapper for broadcast."""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    # We'll use a queue instead for thread safety
-    pass
+    # Serialize once for all clients rather than calling ws_send per client
+    data = orjson.dumps(message)
+    clients = list(state.websocket_clients)
+    results = await asyncio.gather(
+        *[client.send_bytes(data) for client in clients],
+        return_exceptions=True
+    )
+    for client, result in zip(clients, results):
+        if isinstance(result, Exception):
+            state.websocket_clients.discard(client)
 
 # POCT1-A Protocol Implementation
 class POCT1AHandler:
-    def __init__(self):
-        self.control_id = 20000
-
-    def timestamp(self):
-        return datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S-05:00")
-
-    def next_control_id(self):
-        self.control_id += 1
-        return str(self.control_id)
-
-    def create_ack(self, accept=True):
-        """Create acknowledgment. Use accept=False to reject (AR) so device keeps data as unsent."""
-        ack_code = "AA" if accept else "AR"
-        return f"""<ACK.R01>
+    # Outgoing message framing, pre-encoded; filled with control id and timestamp
+    _ACK_TEMPLATE = b"""<ACK.R01>
    <HDR>
-       <HDR.control_id V="{self.next_control_id()}"/>
+       <HDR.control_id V="%s"/>
        <HDR.version_id V="POCT1"/>
-       <HDR.creation_dttm V="{self.timestamp()}"/>
+       <HDR.creation_dttm V="%s"/>
    </HDR>
    <ACK>
-       <ACK.type_cd V="{ack_code}"/>
+       <ACK.type_cd V="%s"/>
    </ACK>
 </ACK.R01>
 """
 
-    def create_request_observations(self):
-        return f"""<REQ.R01>
+    _REQ_TEMPLATE = b"""<REQ.R01>
    <HDR>
-       <HDR.control_id V="{self.next_control_id()}"/>
+       <HDR.control_id V="%s"/>
        <HDR.version_id V="POCT1"/>
-       <HDR.creation_dttm V="{self.timestamp()}"/>
+       <HDR.creation_dttm V="%s"/>
    </HDR>
    <REQ>
        <REQ.request_cd V="ROBS"/>
@@ -123,209 +128,425 @@ class POCT1AHandler:
 </REQ.R01>
 """
 
-# Message queue for thread-safe WebSocket updates
-message_queue = asyncio.Queue()
+    def __init__(self):
+        self.control_id = 20000
+
+    def timestamp(self):
+        # Local wall-clock time with the fixed suffix the device has always been sent
+        return datetime.datetime.now().isoformat(timespec='seconds') + "-05:00"
 
-async def process_message_queue():
-    """Process messages from device thread and broadcast to WebSocket clients."""
-    while True:
-        try:
-            message = await asyncio.wait_for(message_queue.get(), timeout=0.1)
-            await broadcast(message)
-        except asyncio.TimeoutError:
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            print(f"Queue error: {e}")
-
-def queue_message(message: dict):
-    """Thread-safe way to queue a message for WebSocket broadcast."""
-    try:
-        asyncio.get_event_loop().call_soon_threadsafe(
-            lambda: message_queue.put_nowait(message)
+    def next_control_id(self):
+        self.control_id += 1
+        return str(self.control_id)
+
+    def create_ack(self, accept=True):
+        """Create acknowledgment bytes. Use accept=False to reject (AR) so device keeps data as unsent."""
+        ack_code = b"AA" if accept else b"AR"
+        return self._ACK_TEMPLATE % (
+            self.next_control_id().encode(), self.timestamp().encode(), ack_code
         )
-    except:
-        pass
 
-# Device server thread
-def run_device_server(loop):
-    """Run POCT1-A server in a separate thread."""
-    handler = POCT1AHandler()
-    state.server_running = True
+    def create_request_observations(self):
+        return self._REQ_TEMPLATE % (
+            self.next_control_id().encode(), self.timestamp().encode()
+        )
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.settimeout(1.0)
-        s.bind(('0.0.0.0', DEVICE_PORT))
-        s.listen(1)
+# Start of a top-level POCT1-A message, used to resync after a parse error
+_MESSAGE_START = re.compile(rb'<\?xml|<[A-Z]{3}\.R\d\d[\s/>]')
 
-        print(f"📡 Device server listening on port {DEVICE_PORT}")
+class POCT1AStreamParser:
+    """Incremental parser for the stream of POCT1-A messages on a device connection.
+
+    Bytes from each recv() are fed straight into expat, so every byte is
+    tokenized once and messages split across reads are still picked up.
+    Each top-level element (HEL.R01, DST.R01, OBS.R01, ...) is parsed as its
+    own document; once it closes, a fresh expat parser takes over the rest.
+    A message that fails to parse is returned with 'invalid' set, and
+    parsing picks up again at the message after it.
+    """
 
-        while state.server_running:
+    def __init__(self):
+        self._raw = bytearray()
+        self._messages = []
+        self._parser = None
+        self._stack = []
+        self._message = None
+        self._resyncing = False
+        self._resync_pos = 0
+
+    def _create_parser(self):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        self._stack = []
+        return parser
+
+    def _start_element(self, name, attrs):
+        depth = len(self._stack)
+        self._stack.append(name)
+        if depth == 0:
+            self._message = {
+                'type': name, 'values': {}, 'svc_count': 0, 'error': False, 'invalid': False
+            }
+            return
+
+        message = self._message
+        if name == 'SVC':
+            message['svc_count'] += 1
+        elif name.startswith('ERR'):
+            message['error'] = True
+        if 'V' in attrs:
+            message['values'].setdefault(name, attrs['V'])
+
+    def _end_element(self, name):
+        self._stack.pop()
+        if self._stack:
+            return
+
+        # Message complete: cut its bytes off the buffer. The byte index points
+        # at the end tag, or just past the start tag for an empty element.
+        end = self._parser.CurrentByteIndex
+        if self._raw.startswith(b'</' + name.encode(), end):
+            end = self._raw.index(b'>', end) + 1
+        self._message['raw'] = bytes(self._raw[:end])
+        del self._raw[:end]
+        self._messages.append(self._message)
+        self._message = None
+        self._parser = None
+
+    def _resync(self):
+        """Skip the rest of a malformed message.
+
+        Returns True once the buffer starts at the next message, or False if
+        more data is needed to find it.
+        """
+        message = self._message
+        start = _MESSAGE_START.search(self._raw, self._resync_pos)
+
+        if message:
+            end_tag = re.compile(rb'</' + re.escape(message['type'].encode()) + rb'\s*>')
+            end = end_tag.search(self._raw)
+            if end and (start is None or end.start() < start.start()):
+                # Hand the malformed message back; OBS.R01 data is still saved
+                raw = bytes(self._raw[:end.end()])
+                message.update(values={}, svc_count=raw.count(b'<SVC>'), error=False,
+                               invalid=True, raw=raw)
+                self._messages.append(message)
+                del self._raw[:end.end()]
+                self._message = None
+                self._resyncing = False
+                return True
+
+        if start is None:
+            if not message and len(self._raw) > 8:
+                # Keep just enough bytes for a message start split across reads
+                del self._raw[:-8]
+                self._resync_pos = 0
+            return False
+
+        del self._raw[:start.start()]
+        self._message = None
+        self._resyncing = False
+        return True
+
+    def feed(self, data):
+        """Feed received bytes and return the list of messages completed by them."""
+        self._raw += data
+        chunk = data
+        while True:
+            if self._resyncing and not self._resync():
+                break
+            if self._parser is None:
+                # Start the next message at the first non-whitespace byte
+                self._raw = self._raw.lstrip()
+                if not self._raw:
+                    break
+                self._parser = self._create_parser()
+                chunk = bytes(self._raw)
             try:
-                conn, addr = s.accept()
-                handle_device_connection(conn, addr, handler, loop)
-            except socket.timeout:
-                continue
-            except Exception as e:
-                print(f"Server error: {e}")
+                self._parser.Parse(chunk, False)
+                break
+            except xml.parsers.expat.ExpatError as e:
+                if self._parser is not None:
+                    # Malformed message: skip past it and pick up at the next one
+                    print(f"POCT1-A parse error: {e}")
+                    self._parser = None
+                    self._resyncing = True
+                    self._resync_pos = 1
+                # Otherwise trailing bytes belong to the next message; restart on them
+
+        messages, self._messages = self._messages, []
+        return messages
+
+def write_capture(raw: bytes):
+    """Write one raw OBS.R01 message, exactly as received, to a new capture file."""
+    ts = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    filename = CAPTURES_DIR / f"OBS_DATA_{ts}.xml"
+    # O_BINARY (Windows only) stops newline translation on the raw fd
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(filename, flags, 0o644)
+    try:
+        view = memoryview(raw)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def create_device_socket():
+    """Create the bound socket for the device server; start_server() listens on it."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Set before listen() so accepted sockets inherit it from the handshake on
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DEVICE_RCVBUF)
+    except OSError as e:
+        print(f"Could not set receive buffer: {e}")
+    try:
+        s.bind(('0.0.0.0', DEVICE_PORT))
+    except OSError:
+        s.close()
+        raise
+    return s
+
+async def handle_device_connection(reader, writer, handler):
+    """Handle a device connection, serving one device at a time."""
+    task = asyncio.current_task()
+    state.device_tasks.add(task)
+    try:
+        # Transfers share the global state, so a second connection waits
+        # until the current transfer is finished
+        async with state.device_lock:
+            await run_device_transfer(reader, writer, handler)
+    except asyncio.CancelledError:
+        # Server shutdown; this task is the top level of the connection
+        pass
+    finally:
+        state.device_tasks.discard(task)
+        writer.close()
 
-def handle_device_connection(conn, addr, handler, loop):
-    """Handle a device connection."""
+async def run_device_transfer(reader, writer, handler):
+    """Run one device transfer over an accepted connection."""
+    addr = writer.get_extra_info('peername')
     state.device_connected = True
     state.transfer_in_progress = True
     state.observations_received = 0
+    state.last_progress_ns = 0
 
-    asyncio.run_coroutine_threadsafe(
-        broadcast({"type": "status", "status": "connected", "ip": addr[0]}),
-        loop
-    )
+    await broadcast({"type": "status", "status": "connected", "ip": addr[0]})
 
-    with conn:
-        conn.settimeout(120.0)
-        sent_request = False
-        total_available = 0
+    parser = POCT1AStreamParser()
+    sent_request = False
+    total_available = 0
 
-        try:
-            while True:
-                data = conn.recv(8192)
-                if not data:
-                    break
+    try:
+        while True:
+            data = await asyncio.wait_for(reader.read(DEVICE_RECV_SIZE), timeout=120.0)
+            if not data:
+                break
 
-                text = data.decode('utf-8', errors='replace')
+            for message in parser.feed(data):
+                msg_type = message['type']
+                values = message['values']
+
+                # Malformed message: reject (AR) so the device does not wait for an
+                # ACK. A malformed OBS.R01 is still captured below, since the
+                # regex fallback parser copes with bytes that expat rejects.
+                if message['invalid'] and msg_type != 'OBS.R01':
+                    print(f"Rejecting malformed {msg_type} message")
+                    writer.write(handler.create_ack(accept=False))
 
                 # HEL.R01 (Device Hello)
-                if '<HEL.R01>' in text:
-                    serial_match = re.search(r'DEV\.serial_id V="([^"]+)"', text)
-                    model_match = re.search(r'DEV\.model_id V="([^"]+)"', text)
+                elif msg_type == 'HEL.R01':
                     state.device_info = {
-                        'serial': serial_match.group(1) if serial_match else 'Unknown',
-                        'model': model_match.group(1) if model_match else 'Coag-Sense PT/INR'
+                        'serial': values.get('DEV.serial_id', 'Unknown'),
+                        'model': values.get('DEV.model_id', 'Coag-Sense PT/INR')
                     }
-                    asyncio.run_coroutine_threadsafe(
-                        broadcast({"type": "hello", "device": state.device_info}),
-                        loop
-                    )
-                    conn.sendall(handler.create_ack().encode('utf-8'))
+                    writer.write(handler.create_ack())
+                    await broadcast({"type": "hello", "device": state.device_info})
 
                 # DST.R01 (Device Status)
-                elif '<DST.R01>' in text:
-                    count_match = re.search(r'new_observations_qty V="(\d+)"', text)
-                    total_available = int(count_match.group(1)) if count_match else 0
-                    asyncio.run_coroutine_threadsafe(
-                        broadcast({"type": "status_report", "total": total_available}),
-                        loop
-                    )
-                    conn.sendall(handler.create_ack().encode('utf-8'))
+                elif msg_type == 'DST.R01':
+                    count = values.get('DST.new_observations_qty', '')
+                    total_available = int(count) if count.isdecimal() else 0
+                    writer.write(handler.create_ack())
+                    await broadcast({"type": "status_report", "total": total_available})
 
                     if not sent_request:
-                        asyncio.run_coroutine_threadsafe(
-                            broadcast({"type": "requesting"}),
-                            loop
-                        )
-                        conn.sendall(handler.create_request_observations().encode('utf-8'))
+                        writer.write(handler.create_request_observations())
                         sent_request = True
+                        await broadcast({"type": "requesting"})
 
                 # OBS.R01 (Observations)
-                elif '<OBS.R01>' in text or ('<OBS' in text and '<SVC' in text):
-                    svc_count = text.count('<SVC>')
-                    state.observations_received += svc_count
+                elif msg_type == 'OBS.R01':
+                    state.observations_received += message['svc_count']
 
                     # Save raw data
-                    ts = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-                    filename = CAPTURES_DIR / f"OBS_DATA_{ts}.xml"
-                    with open(filename, 'w') as f:
-                        f.write(text)
+                    write_capture(message['raw'])
 
-                    asyncio.run_coroutine_threadsafe(
-                        broadcast({
+                    # Use AA (accept) only if ACCEPT_OBSERVATIONS is set, otherwise AR (reject)
+                    writer.write(handler.create_ack(accept=ACCEPT_OBSERVATIONS))
+
+                    # Throttle progress updates; always send the final one
+                    now = time.monotonic_ns()
+                    if (now - state.last_progress_ns >= PROGRESS_INTERVAL_NS
+                            or state.observations_received >= total_available):
+                        state.last_progress_ns = now
+                        await broadcast({
                             "type": "progress",
                             "received": state.observations_received,
                             "total": total_available
-                        }),
-                        loop
-                    )
-                    # Use AA (accept) only if ACCEPT_OBSERVATIONS is set, otherwise AR (reject)
-                    conn.sendall(handler.create_ack(accept=ACCEPT_OBSERVATIONS).encode('utf-8'))
+                        })
 
                 # EOT.R01 (End of Topic)
-                elif '<EOT.R01>' in text:
-                    conn.sendall(handler.create_ack().encode('utf-8'))
+                elif msg_type == 'EOT.R01':
+                    writer.write(handler.create_ack())
 
                 # Errors
-                elif '<ESC.R01>' in text or '<ERR' in text:
-                    asyncio.run_coroutine_threadsafe(
-                        broadcast({"type": "error", "message": text[:200]}),
-                        loop
-                    )
+                elif msg_type == 'ESC.R01' or message['error']:
+                    # Only the preview shown in the UI is decoded
+                    text = message['raw'][:200].decode('utf-8', errors='replace')
+                    await broadcast({"type": "error", "message": text})
 
-        except socket.timeout:
-            pass
-        except Exception as e:
-            print(f"Connection error: {e}")
+            await writer.drain()
+
+    except asyncio.TimeoutError:
+        pass
+    except Exception as e:
+        print(f"Connection error: {e}")
+    finally:
+        writer.close()
 
     # Transfer complete
     state.device_connected = False
     state.transfer_in_progress = False
 
-    # Parse results
-    results = parse_all_observations()
+    # Parse results off the event loop
+    results = await asyncio.to_thread(parse_all_observations)
 
-    asyncio.run_coroutine_threadsafe(
-        broadcast({
-            "type": "complete",
-            "observations": state.observations_received,
-            "results": results
-        }),
-        loop
-    )
+    await broadcast({
+        "type": "complete",
+        "observations": state.observations_received,
+        "results": results
+    })
+
+# Patterns for fields inside each <SVC> block of a captured OBS.R01 message
+_SVC_SPLIT = re.compile(r'<SVC>(.*?)</SVC>', re.DOTALL)
+_DTTM = re.compile(r'<SVC\.observation_dttm V="([^"]+)"')
+_SEQ = re.compile(r'<SVC\.sequence_nbr V="(\d+)"')
+_STATUS = re.compile(r'<SVC\.status_cd V="([^"]+)"')
+_PATIENT = re.compile(r'<PT\.patient_id V="([^"]+)"')
+_LOT = re.compile(r'<RGT\.lot_number V="([^"]+)"')
+_NOTE = re.compile(r'<NTE\.text V="([^"]+)"')
+
+# OBS.value following an observation_id, one pattern per LOINC code
+_INR = re.compile(r'<OBS\.observation_id V="34714-6"[^/]*/>\s*<OBS\.value V="([^"]+)"')
+_PT_SECONDS = re.compile(r'<OBS\.observation_id V="5902-2"[^/]*/>\s*<OBS\.value V="([^"]+)"')
+
+# SVC fields read from the V attribute of the first matching element
+_SVC_FIELDS = {
+    'SVC.observation_dttm': 'timestamp',
+    'SVC.status_cd': 'status',
+    'PT.patient_id': 'patient_id',
+    'RGT.lot_number': 'reagent_lot',
+    'NTE.text': 'notes',
+}
+
+# OBS.value fields keyed by the LOINC code of the preceding OBS.observation_id
+_LOINC_FIELDS = {
+    '34714-6': 'inr',
+    '5902-2': 'pt_seconds',
+}
+
+def parse_svc_element(svc):
+    """Extract one observation from a parsed <SVC> element."""
+    obs = {}
+    loinc_field = None
+
+    for elem in svc.iter():
+        tag = elem.tag
+        value = elem.get('V')
+
+        if tag == 'OBS.observation_id':
+            loinc_field = _LOINC_FIELDS.get(value)
+            continue
+
+        if tag == 'OBS.value' and loinc_field and value and loinc_field not in obs:
+            try:
+                obs[loinc_field] = float(value)
+            except ValueError:
+                obs[loinc_field] = None
+        elif tag == 'SVC.sequence_nbr' and value and value.isdecimal() and 'sequence' not in obs:
+            obs['sequence'] = int(value)
+        elif tag in _SVC_FIELDS and value and _SVC_FIELDS[tag] not in obs:
+            obs[_SVC_FIELDS[tag]] = value
+        loinc_field = None
+
+    return obs
 
 def parse_obs_file(filepath):
     """Parse a single OBS XML file."""
-    with open(filepath, 'r') as f:
+    observations = []
+
+    try:
+        for _, elem in ET.iterparse(filepath, events=('end',)):
+            if elem.tag != 'SVC':
+                continue
+            obs = parse_svc_element(elem)
+            elem.clear()
+            if obs.get('timestamp'):
+                observations.append(obs)
+    except ET.ParseError:
+        # Captures written by older versions hold raw recv() chunks,
+        # which are not always well-formed XML
+        return parse_obs_text(filepath)
+
+    return observations
+
+def parse_obs_text(filepath):
+    """Regex fallback for OBS captures that are not well-formed XML."""
+    with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
         content = f.read()
 
     observations = []
-    svc_pattern = r'<SVC>(.*?)</SVC>'
-    svc_matches = re.findall(svc_pattern, content, re.DOTALL)
 
-    for svc in svc_matches:
+    for svc in _SVC_SPLIT.findall(content):
         obs = {}
 
-        dttm_match = re.search(r'<SVC\.observation_dttm V="([^"]+)"', svc)
+        dttm_match = _DTTM.search(svc)
         if dttm_match:
             obs['timestamp'] = dttm_match.group(1)
 
-        seq_match = re.search(r'<SVC\.sequence_nbr V="(\d+)"', svc)
+        seq_match = _SEQ.search(svc)
         if seq_match:
             obs['sequence'] = int(seq_match.group(1))
 
-        status_match = re.search(r'<SVC\.status_cd V="([^"]+)"', svc)
+        status_match = _STATUS.search(svc)
         if status_match:
             obs['status'] = status_match.group(1)
 
-        patient_match = re.search(r'<PT\.patient_id V="([^"]+)"', svc)
+        patient_match = _PATIENT.search(svc)
         if patient_match:
             obs['patient_id'] = patient_match.group(1)
 
-        inr_match = re.search(r'<OBS\.observation_id V="34714-6"[^/]*/>\s*<OBS\.value V="([^"]+)"', svc)
+        inr_match = _INR.search(svc)
         if inr_match:
             try:
                 obs['inr'] = float(inr_match.group(1))
             except ValueError:
                 obs['inr'] = None
 
-        pt_match = re.search(r'<OBS\.observation_id V="5902-2"[^/]*/>\s*<OBS\.value V="([^"]+)"', svc)
+        pt_match = _PT_SECONDS.search(svc)
         if pt_match:
             try:
                 obs['pt_seconds'] = float(pt_match.group(1))
             except ValueError:
                 obs['pt_seconds'] = None
 
-        lot_match = re.search(r'<RGT\.lot_number V="([^"]+)"', svc)
+        lot_match = _LOT.search(svc)
         if lot_match:
             obs['reagent_lot'] = lot_match.group(1)
 
-        note_match = re.search(r'<NTE\.text V="([^"]+)"', svc)
+        note_match = _NOTE.search(svc)
         if note_match:
             obs['notes'] = note_match.group(1)
 
@@ -334,33 +555,55 @@ def parse_obs_file(filepath):
 
     return observations
 
-def parse_all_observations():
-    """Parse all captured observations into a results object."""
-    all_observations = []
+# Parsed observations per capture file, keyed by (path, mtime_ns, size)
+# so unchanged captures are not re-read on every transfer
+_PARSE_CACHE = {}
 
-    for filepath in sorted(CAPTURES_DIR.glob('OBS_DATA*.xml')):
-        obs_list = parse_obs_file(filepath)
-        all_observations.extend(obs_list)
+# ((mtime_ns, size), raw bytes) of DATA_FILE as last served by /api/results
+_RESULTS_CACHE = None
 
-    # Remove duplicates
-    seen_sequences = set()
-    unique_observations = []
+def parse_all_observations():
+    """Parse all captured observations into a results object."""
+    global _PARSE_CACHE, _RESULTS_CACHE
+
+    captures = []
+    with os.scandir(CAPTURES_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith('OBS_DATA') and entry.name.endswith('.xml'):
+                st = entry.stat()
+                captures.append((entry.path, (entry.path, st.st_mtime_ns, st.st_size)))
+    captures.sort()
+
+    # Only keep entries for captures that still exist
+    parse_cache = {}
+    for filepath, key in captures:
+        obs_list = _PARSE_CACHE.get(key)
+        if obs_list is None:
+            obs_list = parse_obs_file(filepath)
+        parse_cache[key] = obs_list
+    _PARSE_CACHE = parse_cache
+
+    all_observations = chain.from_iterable(parse_cache.values())
+
+    # Remove duplicates and invalid readings in one pass
+    by_sequence = {}
+    no_sequence = []
     for obs in all_observations:
+        inr = obs.get('inr')
+        pt_seconds = obs.get('pt_seconds')
+        if not (inr and inr > 0 and pt_seconds and pt_seconds > 0):
+            continue
         seq = obs.get('sequence')
-        if seq and seq not in seen_sequences:
-            seen_sequences.add(seq)
-            unique_observations.append(obs)
-        elif not seq:
-            unique_observations.append(obs)
+        if not seq:
+            no_sequence.append(obs)
+        elif seq not in by_sequence:
+            by_sequence[seq] = obs
 
     # Sort by timestamp
-    unique_observations.sort(key=lambda x: x.get('timestamp', ''))
-
-    # Filter invalid readings
-    valid_observations = [
-        obs for obs in unique_observations
-        if obs.get('inr') and obs.get('inr') > 0 and obs.get('pt_seconds') and obs.get('pt_seconds') > 0
-    ]
+    valid_observations = sorted(
+        chain(by_sequence.values(), no_sequence),
+        key=itemgetter('timestamp')
+    )
 
     results = {
         'device': state.device_info,
@@ -369,29 +612,46 @@ def parse_all_observations():
         'readings': valid_observations
     }
 
-    # Save to file
-    with open(DATA_FILE, 'w') as f:
-        json.dump(results, f, indent=2)
+    # Save to file; replace atomically so readers never see a partial file
+    tmp_file = f"{DATA_FILE}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_file, DATA_FILE)
+    _RESULTS_CACHE = None
 
     return results
 
 # FastAPI App
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Start device server in background thread
-    loop = asyncio.get_event_loop()
-    server_thread = threading.Thread(target=run_device_server, args=(loop,), daemon=True)
-    server_thread.start()
+    # Created here so it is bound to uvicorn's event loop on Python 3.9
+    state.device_lock = asyncio.Lock()
 
-    # Start message queue processor
-    asyncio.create_task(process_message_queue())
+    # Start device server on the same event loop as the web app. If the port
+    # is unavailable, keep serving the web UI and existing results without it.
+    try:
+        device_server = await asyncio.start_server(
+            partial(handle_device_connection, handler=POCT1AHandler()),
+            sock=create_device_socket(), backlog=1
+        )
+        print(f"📡 Device server listening on port {DEVICE_PORT}")
+    except OSError as e:
+        device_server = None
+        print(f"Device server error: {e}")
 
     yield
 
-    # Shutdown
-    state.server_running = False
+    if device_server is None:
+        return
 
-app = FastAPI(lifespan=lifespan)
+    # Shutdown: stop accepting, then cancel any transfer still running
+    device_server.close()
+    for task in list(state.device_tasks):
+        task.cancel()
+    await asyncio.gather(*state.device_tasks, return_exceptions=True)
+    await device_server.wait_closed()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 @app.get("/")
 async def index():
@@ -414,18 +674,28 @@ async def get_version_endpoint():
 
 @app.get("/api/results")
 async def get_results():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r') as f:
-            return json.load(f)
-    return {"readings": [], "total_readings": 0}
+    global _RESULTS_CACHE
+    try:
+        f = open(DATA_FILE, 'rb')
+    except FileNotFoundError:
+        return {"readings": [], "total_readings": 0}
+
+    # Serve the file bytes as-is; only re-read when the file changed.
+    # fstat() keys the cache on the same file that is read.
+    with f:
+        st = os.fstat(f.fileno())
+        key = (st.st_mtime_ns, st.st_size)
+        if _RESULTS_CACHE is None or _RESULTS_CACHE[0] != key:
+            _RESULTS_CACHE = (key, f.read())
+    return Response(content=_RESULTS_CACHE[1], media_type="application/json")
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    state.websocket_clients.append(websocket)
+    state.websocket_clients.add(websocket)
 
     # Send initial status
-    await websocket.send_json({
+    await ws_send(websocket, {
         "type": "init",
         "server_ip": state.local_ip,
         "device_port": DEVICE_PORT,
@@ -438,7 +708,7 @@ async def websocket_endpoint(websocket: WebSocket):
             # Keep connection alive
             await websocket.receive_text()
     except WebSocketDisconnect:
-        state.websocket_clients.remove(websocket)
+        state.websocket_clients.discard(websocket)
 
 # Create static directory
 Path("static").mkdir(exist_ok=True)